@@ -2,25 +2,31 @@
 """cooker.py: meta build tool for Yocto Project based Linux embedded systems."""
 
 import argparse
-import importlib.resources
+import contextlib
+import functools
 import json
 import os
 import re
 import shlex
 import sys
-from collections.abc import Iterable, Mapping
+import threading
+from collections.abc import Iterable
 from pathlib import Path
-from urllib.parse import urlparse
-
-import jsonschema
-import pyjson5
 
+# heavy modules (jsonschema, pyjson5, ...) are imported by the functions needing
+# them, so that commands not loading a menu start quickly
+# ruff: noqa: PLC0415
 from .distro import AragoDistro, Distro, NoPokyDistro, PokyDistro
-from .log_format import LogFormat, LogMarkdownFormat, LogTextFormat
+from .distro_probe import DistroProbe
+from .menu_cache import MenuCache
+from .menu_merge import MenuMerge
 from .os_calls import DryRunOsCalls, OsCalls, OsCallsBase
+from .parallel import ParallelTaskError, run_parallel
+from .remote_refs import RemoteRefs
 
 __version__ = "1.4.0"
 BITBAKE_VERSION_MINIMUM = 2
+COMMIT_ID_REGEX = re.compile(r"[0-9a-f]{40}|[0-9a-f]{64}")
 
 
 def debug(*args):
@@ -43,15 +49,33 @@ def fatal_error(*args):
     sys.exit(1)
 
 
-def merge_dicts(base, other):
-    for k, v in other.items():
-        if isinstance(v, Mapping):
-            base[k] = merge_dicts(base.get(k, {}), v)
-        elif isinstance(v, list) and isinstance(base.get(k), list):
-            base[k] += v
-        else:
-            base[k] = v
-    return base
+@functools.cache
+def read_menu_schema():
+    """Returns the text of the JSON schema of the menus."""
+    return (
+        Path(__file__).with_name("cooker-menu-schema.json").read_text(encoding="utf-8")
+    )
+
+
+@functools.cache
+def menu_validator():
+    """Returns the validator of the menus, built (and checked) once per run."""
+    import jsonschema
+    import pyjson5
+
+    schema = pyjson5.loads(read_menu_schema())
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+
+def validate_menu(menu):
+    """Raises the most relevant error of the menu, like jsonschema.validate()."""
+    import jsonschema
+
+    error = jsonschema.exceptions.best_match(menu_validator().iter_errors(menu))
+    if error is not None:
+        raise error
 
 
 class Config:
@@ -66,6 +90,9 @@ class Config:
         "cooker-config-version": 2,
     }
     CURRENT_CONFIG_VERSION = 2
+    CACHE_DIRNAME = ".cookercache"
+    LOCK_FILENAME = ".cookerlock"
+    DEFAULT_REMOTE_REFS_TTL = 600  # seconds
 
     def __init__(self):
         debug("Looking for", Config.DEFAULT_CONFIG_FILENAME)
@@ -189,6 +216,36 @@ class Config:
     def sstate_dir(self, name=""):
         return os.path.join(self.project_root(), self.cfg["sstate-dir"], name)
 
+    def set_mirror_dir(self, path):
+        # mirrors are meant to be shared between projects: keep absolute paths
+        if os.path.isabs(path):
+            self.cfg["mirror-dir"] = os.path.realpath(path)
+        else:
+            self.cfg["mirror-dir"] = os.path.relpath(path, self.project_root())
+
+    def mirror_dir(self, name=""):
+        if not self.cfg.get("mirror-dir"):
+            return None
+        return os.path.join(self.project_root(), self.cfg["mirror-dir"], name)
+
+    def set_remote_refs_ttl(self, seconds):
+        self.cfg["remote-refs-ttl"] = seconds
+
+    def remote_refs_ttl(self):
+        return self.cfg.get("remote-refs-ttl", self.DEFAULT_REMOTE_REFS_TTL)
+
+    def set_server_timeout(self, seconds):
+        self.cfg["server-timeout"] = seconds
+
+    def server_timeout(self):
+        return self.cfg.get("server-timeout")
+
+    def cache_dir(self, name=""):
+        return os.path.join(self.project_root(), self.CACHE_DIRNAME, name)
+
+    def lock_file(self):
+        return os.path.join(self.project_root(), self.LOCK_FILENAME)
+
     def _get_absolute_menu_path_str(self, menu_path_str: str) -> str:
         """Provide the absolute path of a menu based on it starting with a slash."""
         if menu_path_str.startswith("/"):
@@ -217,150 +274,249 @@ class Config:
 
 
 class BuildConfiguration:
-    ALL: dict[str, "BuildConfiguration"] = {}
+    """
+    A build of a BuildGraph, with the settings inherited from its ancestors
+    already merged. It is not modified once created.
+    """
+
+    __slots__ = ("ancestors_", "dir_", "layers_", "local_conf_", "name_", "targets_")
 
     # ruff: noqa: PLR0913 PLR0917
-    def __init__(self, name, config, layers, local_conf, target, inherit):
+    def __init__(self, name, directory, targets, layers, local_conf, ancestors):
         self.name_ = name
-        self.config_ = config
+        self.dir_ = directory
+        self.targets_ = targets  # None for a build which is not buildable
         self.layers_ = layers
         self.local_conf_ = local_conf
-        if type(target) is list:
-            self.targets_ = target
-        elif target:
-            self.targets_ = [target]
-        else:
-            self.targets_ = []
-        self.inherit_ = inherit
-
-        self.parents_ = []  # first level parents
-        self.ancestors_ = []  # all ancestors cleaned of duplicates
-
-        BuildConfiguration.ALL[name] = self
+        self.ancestors_ = ancestors  # names of all ancestors cleaned of duplicates
 
     def targets(self):
-        if not self.buildable():
-            return None
-
-        for build in [self] + self.ancestors_[::-1]:
-            if build.targets_:
-                return build.targets_
+        return self.targets_
 
     def name(self):
         return self.name_
 
     def dir(self):
-        return self.config_.build_dir("build-" + self.name_)
+        return self.dir_
 
     def buildable(self):
-        if self.name_.startswith("."):  # template
-            return False
-
-        return any(build.targets_ for build in self.ancestors_ + [self])
+        return self.targets_ is not None
 
     def layers(self):
-        layers = []
+        return self.layers_
 
-        for build in self.ancestors_ + [self]:
-            for layer in build.layers_:
-                if layer not in layers:
-                    layers.append(layer)
-                else:
-                    debug(
-                        f'ignored - duplicate layer for build "{build.name()}"'
-                        + f': "{layer}"'
-                    )
+    def local_conf(self):
+        return self.local_conf_
 
-        return layers
+    def ancestors(self):
+        return self.ancestors_
 
-    def local_conf(self):
-        lines = []
 
-        for build in self.ancestors_ + [self]:
-            for new_line in build.local_conf_:
-                if new_line in lines:
-                    debug(
-                        "ignored - duplicate line in local.conf for build"
-                        + f' "{build.name()}": "{new_line}"'
-                    )
-                lines.append(new_line)
+class BuildGraph:
+    """
+    The builds of a menu, plus "root" holding the layers and local.conf entries
+    of the menu itself, with their inheritance resolved.
+
+    The layers, local.conf entries and targets of each build are computed when
+    the graph is created, and the graph is not modified afterwards, so several
+    graphs can be used side by side, and from several threads. The ancestors of
+    the builds, as returned by ancestry(), can be given to skip the resolution of
+    the inheritance.
+    """
 
-        return lines
+    def __init__(self, config, menu, ancestors=None):
+        self._builds: dict[str, BuildConfiguration] = {}
+        if not menu:
+            return
 
-    def set_parents(self):
-        debug(f'setting first-level-parents of build "{self.name_}"')
+        settings = {
+            "root": {
+                "layers": menu.get("layers", []),
+                "local.conf": menu.get("local.conf", []),
+            }
+        }
+        for name, build in menu["builds"].items():
+            settings[name] = {"inherit": ["root"], **build}
 
-        if self.inherit_:
-            for parent_name in self.inherit_:
-                if parent_name not in BuildConfiguration.ALL:
-                    fatal_error(
-                        f'build "{self.name}"\'s parent "{parent_name}"'
-                        + " not found in builds-section"
-                    )
+        if ancestors is None:
+            ancestors = self.resolve(settings)
 
-                parent_instance = BuildConfiguration.ALL[parent_name]
+        for name, build in settings.items():
+            chain = [settings[n] for n in ancestors[name]] + [build]
+            targets = None
+            if not name.startswith("."):  # not a template
+                targets = next(
+                    (self.targets(b) for b in reversed(chain) if self.targets(b)), None
+                )
 
-                if parent_instance == self:
-                    fatal_error(
-                        f'"{self.name_}" inherits from itself, that is impossible'
-                    )
+            self._builds[name] = BuildConfiguration(
+                name,
+                config.build_dir("build-" + name),
+                targets,
+                self.merge_layers(chain),
+                self.merge_local_conf(chain),
+                tuple(ancestors[name]),
+            )
 
-                debug(f"adding {parent_instance.name()} as parent to {self.name()}")
-                self.parents_.append(parent_instance)
+    def __contains__(self, name):
+        return name in self._builds
 
-    def get_ancestors(self, start, path=None):
-        if path is None:
-            path = list()
-        path.append(self.name())
+    def __getitem__(self, name):
+        return self._builds[name]
 
-        parents = []
+    def names(self):
+        return self._builds.keys()
 
-        if start in self.parents_:
-            fatal_error(
-                'recursive inheritance detected for "{}" via "{}"'.format(
-                    start.name(), " -> ".join(path + [start.name()])
-                )
-            )
+    def builds(self):
+        return self._builds.values()
 
-        for parent in self.parents_:
-            new_parents = parent.get_ancestors(start, path) + [parent]
+    def ancestry(self):
+        """Returns the names of the ancestors of each build."""
+        return {name: list(b.ancestors()) for name, b in self._builds.items()}
 
-            for new_parent in new_parents:
-                if new_parent in parents:
-                    debug(
-                        f'build "{self.name}" parent "{new_parent.name()}" inherited'
-                        + " multiple times - ignoring"
-                    )
+    @staticmethod
+    def targets(build):
+        target = build.get("target")
+        if type(target) is list:
+            return tuple(target)
+        return (target,) if target else ()
+
+    @staticmethod
+    def merge_layers(chain):
+        layers = {}  # used as an ordered set
+
+        for build in chain:
+            for layer in build.get("layers", []):
+                if layer not in layers:
+                    layers[layer] = None
                 else:
-                    parents.append(new_parent)
+                    debug(f'ignored - duplicate layer: "{layer}"')
 
-        path.pop()
+        return tuple(layers)
 
-        return parents
+    @staticmethod
+    def merge_local_conf(chain):
+        lines = []
+        seen = set()
 
+        for build in chain:
+            for new_line in build.get("local.conf", []):
+                if new_line in seen:
+                    debug(f'ignored - duplicate line in local.conf: "{new_line}"')
+                seen.add(new_line)
+                lines.append(new_line)
 
-def resolve_parents():
-    for _, build in BuildConfiguration.ALL.items():
-        build.set_parents()
+        return tuple(lines)
 
-    for _, build in BuildConfiguration.ALL.items():
-        build.ancestors_ = build.get_ancestors(build)
+    @staticmethod
+    def resolve(settings):
+        """
+        Returns the names of the ancestors of each build: for each parent in
+        order, its ancestors then itself, keeping the first occurrence of each
+        build.
+        """
+        parents = {}
+        for name, build in settings.items():
+            debug(f'setting first-level-parents of build "{name}"')
 
-        debug(
-            f'ancestors of build "{build.name()}": '
-            f'"{[n.name() for n in build.ancestors_]}"'
-        )
+            parents[name] = build.get("inherit") or []
+            for parent in parents[name]:
+                if parent not in settings:
+                    fatal_error(
+                        f'build "{name}"\'s parent "{parent}"'
+                        + " not found in builds-section"
+                    )
+
+                if parent == name:
+                    fatal_error(f'"{name}" inherits from itself, that is impossible')
+
+                debug(f"adding {parent} as parent to {name}")
+
+        ancestors: dict[str, list[str]] = {}
+        for name in settings:
+            if name not in ancestors:
+                BuildGraph.resolve_ancestors(name, parents, ancestors)
+
+            debug(f'ancestors of build "{name}": "{ancestors[name]}"')
+
+        return ancestors
+
+    @staticmethod
+    def resolve_ancestors(name, parents, ancestors):
+        """
+        Resolves the ancestors of the build and of all its unresolved ancestors,
+        each one once, parents first (a depth-first walk without recursion, so
+        that long inheritance chains are supported).
+        """
+        path = {name: None}  # builds being resolved, used as an ordered set
+        stack = [(name, iter(parents[name]))]
+
+        while stack:
+            build, build_parents = stack[-1]
+            parent = next((p for p in build_parents if p not in ancestors), None)
+
+            if parent is None:  # all parents are resolved
+                stack.pop()
+                del path[build]
+
+                merged = {}  # used as an ordered set
+                for build_parent in parents[build]:
+                    for ancestor in ancestors[build_parent] + [build_parent]:
+                        if ancestor in merged:
+                            debug(
+                                f'build "{build}" parent "{ancestor}" inherited'
+                                + " multiple times - ignoring"
+                            )
+                        else:
+                            merged[ancestor] = None
+                ancestors[build] = list(merged)
+            elif parent in path:
+                cycle = list(path)[list(path).index(parent) :] + [parent]
+                fatal_error(
+                    'recursive inheritance detected for "{}" via "{}"'.format(
+                        parent, " -> ".join(cycle)
+                    )
+                )
+            else:
+                path[parent] = None
+                stack.append((parent, iter(parents[parent])))
 
 
-# ruff: noqa: PLR0904
 class CookerCommands:
     """The class aggregates all functions representing a low-level cooker-command"""
 
-    def __init__(self, config, menu):
+    def __init__(self, config, menu, offline=False, refresh=False, graph=None):
         self.config = config
         self.menu = menu
+        self.graph = graph if graph is not None else BuildGraph(config, menu)
         self.distro: Distro = PokyDistro()
 
+        # bare mirrors refreshed during this run, and their access locks
+        self.refreshed_mirrors: set[str] = set()
+        self.mirror_locks: dict[str, threading.Lock] = {}
+        self.mirror_locks_lock = threading.Lock()
+
+        self.submodule_jobs = 1
+
+        # the clone holding the objects of each remote, other sources of the same
+        # remote being its worktrees, the events telling these clones are up to
+        # date and the locks of the git commands writing to them
+        self.source_clones: dict[str, str] = {}
+        self.source_clones_ready: dict[str, threading.Event] = {}
+        self.source_clone_locks: dict[str, threading.Lock] = {}
+
+        # facts about the distro base directory, probed once it is up to date
+        self.distro_probe: DistroProbe | None = None
+        self.refresh = refresh
+
+        self.remote_refs = RemoteRefs(
+            self._ls_remote,
+            config.cache_dir("remote-refs.json"),
+            config.remote_refs_ttl(),
+            offline,
+            refresh,
+        )
+
         if menu:
             distros = {
                 "nopoky": NoPokyDistro(),
@@ -387,6 +543,9 @@ class CookerCommands:
         dl_dir=None,
         sstate_dir=None,
         additional_menus: list[Path] | None = None,
+        mirror_dir=None,
+        remote_refs_ttl=None,
+        server_timeout=None,
     ):
         """cooker-command 'init': (re)set the configuration file"""
         self.config.set_menu(menu_name)
@@ -404,16 +563,206 @@ class CookerCommands:
         if sstate_dir:
             self.config.set_sstate_dir(sstate_dir)
 
+        if mirror_dir:
+            self.config.set_mirror_dir(mirror_dir)
+
+        if remote_refs_ttl is not None:
+            self.config.set_remote_refs_ttl(remote_refs_ttl)
+
+        if server_timeout is not None:
+            self.config.set_server_timeout(server_timeout)
+
         if additional_menus is None:
             additional_menus = list()
 
         self.config.save()
 
-    def update(self):
+    def update(
+        self, jobs=1, submodule_jobs=1, locked=False, builds=None, source_ready=None
+    ):
+        """
+        Update the sources of the menu (or of the given builds). `source_ready`,
+        if given, is called with each source once it is up to date.
+        """
         info("Update layers in project directory")
 
-        for source in self.menu["sources"]:
+        self.submodule_jobs = submodule_jobs
+
+        sources = self.menu["sources"]
+        if builds:
+            sources = self.get_sources_of_builds(builds)
+        if locked:
+            sources = self.locked_sources(sources)
+
+        self.source_clones = {}
+        for source in sources:
+            if source.get("method", "git") == "git":
+                self.source_clones.setdefault(
+                    source["url"], self.local_dir_from_source(source)[0]
+                )
+        self.source_clones_ready = {
+            url: threading.Event() for url in self.source_clones
+        }
+        self.source_clone_locks = {url: threading.Lock() for url in self.source_clones}
+
+        def update_source(source):
             self.update_source(source)
+            if source_ready is not None:
+                source_ready(source)
+
+        try:
+            self.prefetch_remote_refs(sources, jobs)
+            run_parallel(update_source, sources, jobs)
+        except ParallelTaskError as e:
+            fatal_error(f"update of source {e.item['url']} failed ({e.reason})")
+        finally:
+            self.remote_refs.save()
+
+        self.write_lock_file(jobs)
+
+    def get_sources_of_builds(self, builds):
+        """
+        Returns the sources holding the layers of the given builds, and the one of
+        the distro base directory, in menu order.
+        """
+        paths = {self.distro.BASE_DIRECTORY}
+        for build in self.get_buildable_builds(builds):
+            paths.update(build.layers())
+
+        return self.get_sources_of_layers(paths)
+
+    def get_sources_of_layers(self, paths):
+        """
+        Returns the sources holding the given layer paths, in menu order. A layer
+        path held by no source is reported.
+        """
+        sources = []
+        unmatched = set(paths)
+        for source in self.menu["sources"]:
+            local_dir = self.lock_key(source)
+            matched = {
+                p for p in paths if p == local_dir or p.startswith(local_dir + "/")
+            }
+            if matched:
+                sources.append(source)
+                unmatched -= matched
+
+        for path in sorted(unmatched):
+            warn(f"layer {path} is not held by any source of the menu")
+
+        return sources
+
+    def lock_key(self, source):
+        """Returns the local directory of the source, relative to the layer dir."""
+        # local_dir_from_source() resolves symlinks, so must the layer dir
+        return os.path.relpath(
+            self.local_dir_from_source(source)[0],
+            os.path.realpath(self.config.layer_dir()),
+        )
+
+    def locked_sources(self, sources):
+        """Return the sources pinned to the commits recorded in the lock file."""
+        try:
+            with open(self.config.lock_file(), encoding="utf-8") as file:
+                lock = json.load(file)["sources"]
+        except (OSError, ValueError, KeyError) as e:
+            fatal_error("lock file load error:", e)
+
+        locked = []
+        for source in sources:
+            if source.get("method", "git") == "git":
+                entry = lock.get(self.lock_key(source))
+                if entry is None or entry["url"] != source["url"]:
+                    fatal_error(
+                        f"source {source['url']} is not in the lock file,"
+                        + " run `cooker update` without `--locked` first"
+                    )
+                locked.append({**source, "rev": entry["commit"]})
+            else:
+                locked.append(source)
+        return locked
+
+    def lock_entry(self, source):
+        if source.get("method", "git") != "git":
+            return None
+
+        local_dir = self.local_dir_from_source(source)[0]
+        if not os.path.isdir(local_dir):
+            return None
+
+        commit = CookerCommands._git_output(["git", "rev-parse", "HEAD"], local_dir)
+        if commit is None or not COMMIT_ID_REGEX.fullmatch(commit):
+            return None
+
+        return self.lock_key(source), {
+            "url": source["url"],
+            "branch": source.get("branch", ""),
+            "rev": source.get("rev", ""),
+            "commit": commit,
+        }
+
+    def write_lock_file(self, jobs):
+        """
+        Record the commit checked out for each source in the lock file. Entries of
+        sources which are not checked out (e.g. not needed by the updated builds)
+        are kept.
+        """
+        try:
+            with open(self.config.lock_file(), encoding="utf-8") as file:
+                previous = json.load(file)
+        except (OSError, ValueError):
+            previous = {}
+        locked = previous.get("sources", {}) if isinstance(previous, dict) else {}
+
+        entries = run_parallel(self.lock_entry, self.menu["sources"], jobs)
+        sources = {}
+        for source, entry in zip(self.menu["sources"], entries, strict=True):
+            if entry is not None:
+                sources[entry[0]] = entry[1]
+            elif source.get("method", "git") == "git":
+                key = self.lock_key(source)
+                if locked.get(key, {}).get("url") == source["url"]:
+                    sources[key] = locked[key]
+
+        lock = {"sources": sources}
+        if not sources or lock == previous:  # nothing checked out (or dry-run)
+            return
+
+        debug("Saving lock file")
+        with open(self.config.lock_file(), "w", encoding="utf-8") as file:
+            json.dump(lock, file, indent=4)
+
+    @staticmethod
+    def _ls_remote(url, refs):
+        # the patterns are only matched by git once the refs are received: the
+        # remote is restricted to the tags and/or the branches by the options
+        command = ["git", "ls-remote"]
+        if all(ref.startswith(("refs/tags/", "refs/heads/")) for ref in refs):
+            if any(ref.startswith("refs/tags/") for ref in refs):
+                command.append("--tags")
+            if any(ref.startswith("refs/heads/") for ref in refs):
+                command.append("--heads")
+        return CookerCommands._git_output([*command, url, *refs], None)
+
+    def prefetch_remote_refs(self, sources, jobs):
+        """
+        Ask, in a single query per remote, for the tags of the sources to be cloned
+        when a remote hosts several of them.
+        """
+        tags: dict[str, list[str]] = {}
+        for source in sources:
+            rev = source.get("rev", "")
+            if (
+                source.get("method", "git") != "git"
+                or not rev
+                or COMMIT_ID_REGEX.fullmatch(rev)
+                or os.path.isdir(self.local_dir_from_source(source)[0])
+            ):
+                continue
+            tags.setdefault(source["url"], []).append(f"refs/tags/{rev}")
+
+        shared = [(url, refs) for url, refs in tags.items() if len(refs) > 1]
+        run_parallel(lambda item: self.remote_refs.resolve(*item), shared, jobs)
 
     def local_dir_from_source(self, source):
         if "dir" in source:
@@ -423,6 +772,8 @@ class CookerCommands:
             if "url" in source:
                 try:
                     if "://" in source["url"]:
+                        from urllib.parse import urlparse
+
                         url = urlparse(source["url"])
                         local_dir = url.path[1:]
                     elif ":" in source["url"]:  # must be short URL
@@ -447,30 +798,164 @@ class CookerCommands:
 
         branch = source.setdefault("branch", "")
         rev = source.setdefault("rev", "")
+        clone = self.clone_mode(source)
+        submodules = source.get("submodules", "full")
 
-        if not os.path.isdir(local_dir):
-            self.update_directory_initial(method, local_dir, remote_dir, branch, rev)
+        clone_dir = self.source_clones.get(remote_dir, local_dir)
+        worktree = method == "git" and clone_dir != local_dir
 
-        if CookerCall.os.directory_exists(local_dir):
-            self.update_directory(method, local_dir, remote_dir, branch, rev)
+        if worktree:
+            # the clone is handled by a source coming first in the menu, so it has
+            # already been started, even when sources are updated in parallel; the
+            # worktrees are updated once it is up to date, from what it fetched
+            self.source_clones_ready[remote_dir].wait()
 
-    @staticmethod
-    def update_directory_initial(method, local_dir, remote_dir, branch, rev):
+        fresh = not os.path.isdir(local_dir)
+        try:
+            if fresh:
+                if worktree:
+                    self.add_worktree(local_dir, remote_dir, clone_dir, rev)
+                else:
+                    mirror = None
+                    if method == "git":
+                        mirror = self.update_mirror(remote_dir)
+                    self.update_directory_initial(
+                        method,
+                        local_dir,
+                        remote_dir,
+                        branch,
+                        rev,
+                        mirror,
+                        clone,
+                        submodules,
+                    )
+
+            if CookerCall.os.directory_exists(local_dir):
+                self.update_directory(
+                    method,
+                    local_dir,
+                    remote_dir,
+                    branch,
+                    rev,
+                    clone,
+                    submodules,
+                    worktree,
+                    fresh,
+                )
+        finally:
+            if not worktree and remote_dir in self.source_clones_ready:
+                self.source_clones_ready[remote_dir].set()
+
+    def add_worktree(self, local_dir, remote_dir, clone_dir, rev):
+        """
+        Check out a source as a worktree of the clone of another source of the same
+        remote: the objects are shared, nothing is cloned again.
+        """
+        if not CookerCall.os.directory_exists(clone_dir):
+            fatal_error(f"cannot add worktree {local_dir}: {clone_dir} was not cloned")
+
+        info(f"Adding worktree {local_dir} of {clone_dir}")
+        command = ["git", "worktree", "add", "--detach", local_dir]
+        if rev and CookerCommands.has_revision(clone_dir, rev):
+            command.append(rev)
+        with self.source_clone_lock(remote_dir):
+            CookerCommands._run_git_command(command, clone_dir)
+
+    def source_clone_lock(self, remote_dir):
+        """
+        Return the lock serializing the git commands writing to the clone shared
+        by the worktrees of a remote (its refs are updated by each fetch).
+        """
+        return self.source_clone_locks.get(remote_dir) or contextlib.nullcontext()
+
+    def clone_mode(self, source):
+        """
+        Returns the clone mode of a source: its own, the menu's default or "full".
+        A shallow clone needs a "rev" to pin, other sources are cloned blobless.
+        """
+        clone = source.get("clone", self.menu.get("clone", "full"))
+        if clone == "shallow" and not source.get("rev"):
+            debug(f'source {source["url"]} has no "rev", cloning it blobless')
+            clone = "blobless"
+        return clone
+
+    def mirror_lock(self, mirror):
+        with self.mirror_locks_lock:
+            return self.mirror_locks.setdefault(mirror, threading.Lock())
+
+    def update_mirror(self, remote_dir):
+        """
+        Create or refresh (once per run) the bare mirror of a remote in the mirror
+        directory and return its path, or None if no mirror directory is configured.
+        """
+        mirror_root = self.config.mirror_dir()
+        if mirror_root is None:
+            return None
+
+        name = re.sub(r"[^\w.-]+", "_", remote_dir.split("://")[-1]).strip("_")
+        mirror = os.path.join(mirror_root, name.removesuffix(".git") + ".git")
+
+        # the lock file serializes the cooker processes sharing the mirror
+        with self.mirror_lock(mirror):
+            if mirror in self.refreshed_mirrors:
+                return mirror
+
+            CookerCall.os.create_directory(mirror_root)
+            with CookerCall.os.file_lock(mirror + ".lock"):
+                if not os.path.isdir(mirror):
+                    info("Creating mirror of", remote_dir)
+                    CookerCommands._run_git_command(
+                        ["git", "clone", "--mirror", remote_dir, mirror], None
+                    )
+                else:
+                    info("Refreshing mirror of", remote_dir)
+                    CookerCommands._run_git_command(["git", "fetch", "origin"], mirror)
+
+            self.refreshed_mirrors.add(mirror)
+
+        return mirror
+
+    def is_tag(self, remote_dir, rev):
+        """Tell whether the revision is a tag of the remote (a commit id is not)."""
+        if not rev or COMMIT_ID_REGEX.fullmatch(rev):
+            return False
+        return self.remote_refs.has_tag(remote_dir, rev)
+
+    def update_directory_initial(
+        self,
+        method,
+        local_dir,
+        remote_dir,
+        branch,
+        rev,
+        mirror,
+        clone="full",
+        submodules="full",
+    ):
         info("Downloading source from ", remote_dir)
         if method == "git":
-            complete = CookerCall.os.subprocess_run(
-                ["git", "ls-remote", remote_dir], None
-            )
-            if complete.stdout is not None:
-                refs = complete.stdout.decode("utf-8")
-            else:
-                refs = ""
-
-            command = ["git", "clone", "--recurse-submodules", remote_dir, local_dir]
-            if re.search("refs/tags/" + rev + "$", refs, re.MULTILINE):
+            command = ["git", "clone"]
+            if submodules != "none":
+                command.append("--recurse-submodules")
+                if clone == "shallow" or submodules == "shallow":
+                    command.append("--shallow-submodules")
+                if self.submodule_jobs > 1:
+                    command.extend(["--jobs", str(self.submodule_jobs)])
+            if mirror:
+                command.extend(["--reference", mirror])
+            if clone == "blobless":
+                command.append("--filter=blob:none")
+            elif clone == "shallow":
+                command.extend(["--depth", "1"])
+            command.extend([remote_dir, local_dir])
+            if self.is_tag(remote_dir, rev):
                 command.extend(["--branch", rev])
-            elif branch:
-                command.extend(["--branch", branch])
+            else:
+                if branch:
+                    command.extend(["--branch", branch])
+                if clone == "shallow":
+                    # the pinned commit is fetched by update_directory()
+                    command.append("--no-checkout")
 
             complete = CookerCall.os.subprocess_run(command, None)
             if complete.returncode != 0:
@@ -493,25 +978,166 @@ class CookerCommands:
             )
 
     @staticmethod
-    def update_directory(method, local_dir, has_remote, branch, rev):
+    def _git_output(cmd_list, directory):
+        """Run a git query, return its output or None if it failed."""
+        complete = CookerCall.os.subprocess_run(cmd_list, directory)
+        if complete.returncode != 0 or complete.stdout is None:
+            return None
+        return complete.stdout.decode("utf-8", errors="replace").strip()
+
+    @staticmethod
+    def is_head_at(local_dir, rev):
+        """Tell whether HEAD is the commit of the revision, ignoring the worktree."""
+        commits = CookerCommands._git_output(
+            ["git", "rev-parse", "HEAD", f"{rev}^{{commit}}"], local_dir
+        )
+        if commits is None:
+            return False
+
+        head, _, pinned = commits.partition("\n")
+        return head == pinned
+
+    @staticmethod
+    def is_at_revision(local_dir, rev, submodules="full"):
+        """
+        Check, without any network access, whether the source is checked out at the
+        given revision with no local modification, and with its submodules checked
+        out at their recorded commits (unless they are not updated).
+        """
+        if not CookerCommands.is_head_at(local_dir, rev):
+            return False
+
+        status = CookerCommands._git_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"], local_dir
+        )
+        if status != "":
+            return False
+
+        return submodules == "none" or CookerCommands.submodules_in_sync(local_dir)
+
+    @staticmethod
+    def submodules_in_sync(local_dir):
+        """
+        Tell whether all the submodules of the source are initialized and checked
+        out at the commits recorded in the source.
+        """
+        status = CookerCommands._git_output(
+            ["git", "submodule", "status", "--recursive"], local_dir
+        )
+        if status is None:
+            return False
+
+        return not any(line[:1] in {"-", "+", "U"} for line in status.splitlines())
+
+    @staticmethod
+    def has_revision(local_dir, rev):
+        """Tell whether the commit of a revision is already in the local clone."""
+        return (
+            CookerCommands._git_output(
+                ["git", "rev-parse", "--verify", "--quiet", f"{rev}^{{commit}}"],
+                local_dir,
+            )
+            is not None
+        )
+
+    def fetch_revision(self, local_dir, remote_dir, rev, clone):
+        """
+        Fetch only what is needed to check out a revision: its tag or its commit.
+        Other revisions (branch names, abbreviated commit ids) need a full fetch.
+        """
+        fetch = ["git", "fetch"]
+        if clone == "shallow":
+            fetch.extend(["--depth", "1"])
+        fetch.append("origin")
+
+        if self.is_tag(remote_dir, rev):
+            CookerCommands._run_git_command([*fetch, "tag", rev], local_dir)
+        elif COMMIT_ID_REGEX.fullmatch(rev) or clone == "shallow":
+            complete = CookerCall.os.subprocess_run([*fetch, rev], local_dir)
+            if complete.returncode != 0:
+                # the server may refuse to send a commit not pointed to by a ref
+                debug(complete.stderr.decode("utf-8", errors="replace"))
+                CookerCommands._run_git_command(fetch, local_dir)
+        else:
+            CookerCommands._run_git_command(fetch, local_dir)
+
+    def update_directory(
+        self,
+        method,
+        local_dir,
+        has_remote,
+        branch,
+        rev,
+        clone="full",
+        submodules="full",
+        worktree=False,
+        fresh=False,
+    ):
+        """
+        Update a source to its revision, or to the head of its branch. `fresh`
+        tells that the source was just cloned (or added as a worktree): unless it
+        is already up to date, its submodules are then updated even if its commit
+        does not change.
+        """
         if method != "git":
             return
 
+        head = None
+        if not fresh:
+            head = CookerCommands._git_output(["git", "rev-parse", "HEAD"], local_dir)
+
         if rev:
+            if CookerCommands.is_at_revision(local_dir, rev, submodules):
+                info(f"Source {local_dir} is already at revision {rev}")
+                return
+
             info(f"Updating source {local_dir}... ")
-            CookerCommands._run_git_command(["git", "fetch"], local_dir)
+            if worktree:
+                self.fetch_worktree_commit(
+                    local_dir,
+                    has_remote,
+                    rev,
+                    lambda: self.fetch_revision(local_dir, has_remote, rev, clone),
+                )
+            elif not CookerCommands.has_revision(local_dir, rev):
+                self.fetch_revision(local_dir, has_remote, rev, clone)
             CookerCommands._run_git_command(["git", "checkout", rev], local_dir)
         elif branch:
             warn(
                 f'source "{local_dir}" has no "rev" field, the build will not'
                 + " be reproducible!"
             )
+            remote_head = self.remote_refs.branch_head(has_remote, branch)
+            if remote_head is not None and CookerCommands.is_at_revision(
+                local_dir, remote_head, submodules
+            ):
+                info(f"Source {local_dir} is already at the head of branch {branch}")
+                return
+
             info(f"Updating source {local_dir}... ")
-            if has_remote:
-                CookerCommands._run_git_command(["git", "fetch", "--all"], local_dir)
-            CookerCommands._run_git_command(["git", "checkout", branch], local_dir)
-            if has_remote:
-                CookerCommands._run_git_command(["git", "pull"], local_dir)
+            if worktree:
+                # a branch can only be checked out in one worktree: detach
+                commit = self.fetch_worktree_commit(
+                    local_dir,
+                    has_remote,
+                    remote_head,
+                    lambda: CookerCommands._run_git_command(
+                        ["git", "fetch", "origin", branch], local_dir
+                    ),
+                )
+                CookerCommands._run_git_command(
+                    ["git", "checkout", "--detach", commit], local_dir
+                )
+            else:
+                if has_remote:
+                    CookerCommands._run_git_command(
+                        ["git", "fetch", "origin", branch], local_dir
+                    )
+                CookerCommands._run_git_command(["git", "checkout", branch], local_dir)
+                if has_remote:
+                    CookerCommands._run_git_command(
+                        ["git", "merge", "--ff-only", "FETCH_HEAD"], local_dir
+                    )
         else:
             warn(
                 f'WARNING! source "{local_dir}" has no "rev" nor "branch" field, '
@@ -519,83 +1145,102 @@ class CookerCommands:
             )
 
             info(f"Trying to update source {local_dir}... ")
-            if has_remote:
+            if worktree:
+                commit = self.fetch_worktree_commit(
+                    local_dir,
+                    has_remote,
+                    None,
+                    lambda: CookerCommands._run_git_command(
+                        ["git", "fetch", "origin", "HEAD"], local_dir
+                    ),
+                )
+                CookerCommands._run_git_command(
+                    ["git", "checkout", "--detach", commit], local_dir
+                )
+            elif has_remote:
                 CookerCommands._run_git_command(["git", "pull"], local_dir)
 
-        CookerCommands._run_git_command(
-            ["git", "submodule", "update", "--recursive", "--init"], local_dir
-        )
-
-    def diff(self):
-        for source in self.menu["sources"]:
-            local_dir = self.local_dir_from_source(source)[0]
-            source_name = os.path.basename(local_dir)
-            debug(f"check the diff of the source {source_name}")
+        self.update_submodules(local_dir, head, submodules)
 
-            if "rev" not in source:
-                debug(f"no revision field in the menu file for source {source_name}")
-                continue
+    def fetch_worktree_commit(self, local_dir, remote_dir, rev, fetch):
+        """
+        Make sure the commit of a revision is in the clone shared by a worktree and
+        return the revision to check out. The clone has been updated first, so the
+        commit is usually there already: `fetch` is only called, one worktree of the
+        clone at a time, when it is not (or when the revision is unknown, None, in
+        which case the fetched commit, FETCH_HEAD, is returned).
+        """
+        if rev is not None and CookerCommands.has_revision(local_dir, rev):
+            return rev
 
-            menu_rev = source["rev"]
+        with self.source_clone_lock(remote_dir):
+            # another worktree may have fetched it while this one was waiting
+            if rev is None or not CookerCommands.has_revision(local_dir, rev):
+                fetch()
+        return rev if rev is not None else "FETCH_HEAD"
 
-            if not CookerCall.os.directory_exists(local_dir):
-                warn(f"{local_dir} directory of source {source_name} does not exist")
-                continue
+    def update_submodules(self, local_dir, previous_head, submodules):
+        """
+        Update the submodules of a source, unless its policy is "none" or the
+        commit of the source did not change and its submodules are in sync.
+        """
+        if submodules == "none":
+            return
 
-            complete = CookerCall.os.subprocess_run(
-                ["git", "describe", "--abbrev=7", "--tags", "--always", "--dirty"],
-                local_dir,
-            )
-            if complete.returncode != 0:
-                warn(
-                    f"unable to get the current revision "
-                    f"of the local source {local_dir}"
-                )
-                debug(complete.stderr.decode("utf-8", errors="replace"))
-                continue
+        head = CookerCommands._git_output(["git", "rev-parse", "HEAD"], local_dir)
+        if (
+            head is not None
+            and head == previous_head
+            and CookerCommands.submodules_in_sync(local_dir)
+        ):
+            debug(f"source {local_dir} did not change, submodules are not updated")
+            return
 
-            local_rev = complete.stdout.strip().decode("utf-8", errors="replace")
-            debug(f"menu revision: {menu_rev}, local revision: {local_rev}")
-            if menu_rev != local_rev:
-                print(f"{source_name}: {menu_rev} .. {local_rev}")
+        command = ["git", "submodule", "update", "--recursive", "--init"]
+        if submodules == "shallow":
+            command.extend(["--depth", "1"])
+        if self.submodule_jobs > 1:
+            command.extend(["--jobs", str(self.submodule_jobs)])
+        CookerCommands._run_git_command(command, local_dir)
 
-    def generate_build_config_from_menu(self, menu, build_name):
-        """
-        Generates the BuildConfiguration classes from the given menu version.
-        Resolve the parents and returns the BuildConfiguration class of the build.
+    def diff(self, jobs=1, fast=False):
+        run_parallel(
+            lambda source: self.diff_source(source, fast), self.menu["sources"], jobs
+        )
 
-        Backup and restore the ALL BuildConfiguration class variable to avoid
-        overwriting the existing content.
-        """
-        backup = BuildConfiguration.ALL
-        BuildConfiguration.ALL = {}
+    def diff_source(self, source, fast):
+        local_dir = self.local_dir_from_source(source)[0]
+        source_name = os.path.basename(local_dir)
+        debug(f"check the diff of the source {source_name}")
 
-        BuildConfiguration(
-            "root",
-            self.config,
-            menu.setdefault("layers", []),
-            menu.setdefault("local.conf", []),
-            None,
-            None,
-        )
+        if "rev" not in source:
+            debug(f"no revision field in the menu file for source {source_name}")
+            return
 
-        for name, build in menu["builds"].items():
-            BuildConfiguration(
-                name,
-                self.config,
-                build.setdefault("layers", []),
-                build.setdefault("local.conf", []),
-                build.setdefault("target", None),
-                build.setdefault("inherit", ["root"]),
-            )
+        menu_rev = source["rev"]
 
-        resolve_parents()
+        if not CookerCall.os.directory_exists(local_dir):
+            warn(f"{local_dir} directory of source {source_name} does not exist")
+            return
 
-        build_config = BuildConfiguration.ALL[build_name]
+        # comparing commit ids is much cheaper than describing a dirty worktree
+        if fast and CookerCommands.is_head_at(local_dir, menu_rev):
+            debug(f"source {source_name} is at the menu revision {menu_rev}")
+            return
 
-        BuildConfiguration.ALL = backup
+        complete = CookerCall.os.subprocess_run(
+            ["git", "describe", "--abbrev=7", "--tags", "--always", "--dirty"],
+            local_dir,
+        )
+        if complete.returncode != 0:
+            warn(f"unable to get the current revision of the local source {local_dir}")
+            debug(complete.stderr.decode("utf-8", errors="replace"))
+            return
 
-        return build_config
+        local_rev = complete.stdout.strip().decode("utf-8", errors="replace")
+        debug(f"menu revision: {menu_rev}, local revision: {local_rev}")
+        if menu_rev != local_rev:
+            print(f"{source_name}: {menu_rev} .. {local_rev}")
 
     def get_sources_from_build_layers(self, menu, layers):
         """
@@ -614,7 +1259,9 @@ class CookerCommands:
         return sources
 
     @staticmethod
-    def load_and_validate_menu(menu_file, schema):
+    def load_and_validate_menu(menu_file):
+        import pyjson5
+
         with open(menu_file, encoding="utf-8") as file:
             try:
                 menu = pyjson5.load(file)
@@ -622,7 +1269,7 @@ class CookerCommands:
                 fatal_error("menu load error:", e)
 
             try:
-                jsonschema.validate(menu, schema)
+                validate_menu(menu)
             except Exception as e:
                 fatal_error(f"menu file {menu_file} validation failed:", e)
 
@@ -635,28 +1282,21 @@ class CookerCommands:
         version.
         """
 
-        schema_file = (
-            importlib.resources.files("cooker")
-            .joinpath("cooker-menu-schema.json")
-            .read_text()
-        )
-        schema = pyjson5.loads(schema_file)
-        menu_from = self.load_and_validate_menu(menu_from_file, schema)
+        menu_from = self.load_and_validate_menu(menu_from_file)
         menu_to = self.menu
 
         if build_name not in menu_from["builds"] or build_name not in menu_to["builds"]:
             fatal_error(f"build `{build_name}` does not exist in the menu file")
 
-        # Generates a BuildConfiguration class for the menu since the build layers
-        # can change between menu version. If 'menu to' is omitted, use the
-        # current up-to-date BuildConfiguration class.
+        # Resolves the builds of the menu since the build layers can change between
+        # menu version. If 'menu to' is omitted, use the current build graph.
 
-        build_config_from = self.generate_build_config_from_menu(menu_from, build_name)
-        build_config_to = BuildConfiguration.ALL[build_name]
+        build_config_from = BuildGraph(self.config, menu_from)[build_name]
+        build_config_to = self.graph[build_name]
 
         if menu_to_file is not None:
-            menu_to = self.load_and_validate_menu(menu_to_file, schema)
-            build_config_to = self.generate_build_config_from_menu(menu_to, build_name)
+            menu_to = self.load_and_validate_menu(menu_to_file)
+            build_config_to = BuildGraph(self.config, menu_to)[build_name]
 
         # Gets the sources used by the build from the list of layers.
 
@@ -693,6 +1333,7 @@ class CookerCommands:
                 if source in history and CookerCall.os.directory_exists(
                     self.config.layer_dir(source)
                 ):
+                    self.unshallow(self.config.layer_dir(source))
                     complete = CookerCall.os.subprocess_run(
                         [
                             "git",
@@ -712,6 +1353,12 @@ class CookerCommands:
                     ).splitlines()
 
         # Prints the formatted log output from the changes dict.
+        from .log_format import (
+            LogFormat,
+            LogMarkdownFormat,
+            LogTextFormat,
+        )
+
         log: LogFormat
         if log_format in {"md", "markdown"}:
             log = LogMarkdownFormat(changes)
@@ -721,14 +1368,126 @@ class CookerCommands:
         log.generate()
         log.display()
 
-    def generate(self):
-        info("Generating dirs for all build-configurations")
+    @staticmethod
+    def unshallow(local_dir):
+        """Fetch the history of a source cloned in shallow mode."""
+        complete = CookerCall.os.subprocess_run(
+            ["git", "rev-parse", "--is-shallow-repository"], local_dir
+        )
+        if complete.stdout is None or complete.stdout.strip() != b"true":
+            return
+
+        info(f"Fetching the history of shallow source {local_dir}")
+        complete = CookerCall.os.subprocess_run(
+            ["git", "fetch", "--unshallow", "origin"], local_dir
+        )
+        if complete.returncode != 0:
+            warn(f"unable to fetch the history of the source {local_dir}")
+            debug(complete.stderr.decode("utf-8", errors="replace"))
+
+    def cook(
+        self,
+        builds,
+        jobs=1,
+        submodule_jobs=1,
+        locked=False,
+        sdk=False,
+        keepgoing=False,
+        download=False,
+        parallel_builds=1,
+    ):
+        """
+        Update, generate and build. With more than one job, this is a pipeline: the
+        sources are updated in the background and each build is generated and
+        built as soon as the sources holding its layers are ready. With parallel
+        builds, all the sources are updated before the builds are scheduled.
+        """
+        if jobs <= 1 or parallel_builds > 1:
+            self.update(jobs, submodule_jobs, locked, builds)
+            self.generate(builds, jobs)
+            self.build(builds, sdk, keepgoing, download, parallel_builds)
+            return
+
+        buildables = self.get_buildable_builds(builds)
+
+        ready: set[str] = set()
+        errors: list[BaseException] = []
+        changed = threading.Condition()
+
+        def source_ready(source):
+            with changed:
+                ready.add(self.lock_key(source))
+                changed.notify_all()
+
+        def update():
+            try:
+                self.update(jobs, submodule_jobs, locked, builds, source_ready)
+            except BaseException as e:  # re-raised by the main thread
+                errors.append(e)
+            finally:
+                with changed:
+                    changed.notify_all()
+
+        updater = threading.Thread(target=update, daemon=True)
+
+        def needed_sources(paths):
+            return {self.lock_key(s) for s in self.get_sources_of_layers(paths)}
+
+        def wait_for_first_ready(pending):
+            """Wait for the sources of one of the pending items, return this item."""
+            with changed:
+                changed.wait_for(
+                    lambda: (
+                        any(needed <= ready for needed in pending.values())
+                        or not updater.is_alive()
+                    )
+                )
+                for item, needed in pending.items():
+                    if needed <= ready:
+                        del pending[item]
+                        return item
+            updater.join()
+            if errors:
+                raise errors[0]
+            fatal_error("sources of", ", ".join(pending), "were not updated")
+
+        updater.start()
+
+        base = self.distro.BASE_DIRECTORY
+        wait_for_first_ready({base: needed_sources([base])})
+        self.read_local_conf_version()
+        self.read_bitbake_version()
+
+        pending = {build.name(): needed_sources(build.layers()) for build in buildables}
+        while pending:
+            build = self.graph[wait_for_first_ready(pending)]
+            info(f"Generating dirs for {build.name()}")
+            self.prepare_build_directory(build)
+            self.build_targets(build, sdk, keepgoing, download)
+
+        updater.join()
+        if errors:
+            raise errors[0]
+
+    def generate(self, builds=None, jobs=1):
+        """
+        Prepare the directories of the given builds (all buildable ones by default),
+        up to `jobs` of them in parallel.
+        """
+        if builds:
+            info("Generating dirs for build-configurations", ", ".join(builds))
+        else:
+            info("Generating dirs for all build-configurations")
+
+        buildables = self.get_buildable_builds(builds)
 
         self.read_local_conf_version()
+        self.read_bitbake_version()
 
-        for build in BuildConfiguration.ALL.values():
-            if build.buildable():
-                self.prepare_build_directory(build)
+        try:
+            run_parallel(self.prepare_build_directory, buildables, jobs)
+        except ParallelTaskError as e:
+            fatal_error(f"generation of build {e.item.name()} failed ({e.reason})")
 
     def generate_distro_base_dir_path(self):
         """
@@ -736,89 +1495,30 @@ class CookerCommands:
         """
         return os.path.join(self.config.layer_dir(), self.distro.BASE_DIRECTORY)
 
+    def get_distro_probe(self):
+        """Returns the probe of the distro base directory, created on first use."""
+        if self.distro_probe is None:
+            self.distro_probe = DistroProbe(
+                self.distro,
+                self.generate_distro_base_dir_path(),
+                self.config.cache_dir("distro-probe.json"),
+                self.refresh,
+                read_only=isinstance(CookerCall.os, DryRunOsCalls),
+            )
+        return self.distro_probe
+
     def get_template_conf_path(self):
         """
         This method returns the relative path to the directory containing the
         local.conf.sample file
         """
-        for template_conf in self.distro.TEMPLATE_CONF:
-            full_path = os.path.join(
-                self.generate_distro_base_dir_path(), template_conf, "local.conf.sample"
-            )
-            if os.path.exists(full_path):
-                return template_conf
-        return
-
-    def get_template_conf_full_path(self):
-        """
-        This method returns the full path to the directory containing the
-        local.conf.sample file
-        """
-        template_conf_path = self.get_template_conf_path()
-        if template_conf_path is None:
-            # Raises an Error when we don't find the local.conf.sample in template conf
-            # dir
-            raise FileNotFoundError(
-                "Can't find local.conf.sample file in any of the following folders:"
-                + f" {' '.join(self.distro.TEMPLATE_CONF)}"
-            )
-        else:
-            full_path = os.path.join(
-                self.generate_distro_base_dir_path(),
-                template_conf_path,
-                "local.conf.sample",
-            )
-            return full_path
-        return
+        return self.get_distro_probe().template_conf()
 
     def read_local_conf_version(self):
-        self.local_conf_version = str(self.distro.DEFAULT_CONF_VERSION)
-
-        try:
-            with open(self.get_template_conf_full_path(), encoding="utf-8") as file:
-                for line in file:
-                    if not line.lstrip().startswith("CONF_VERSION"):
-                        continue
-
-                    match = re.search(r"\d+", line)
-
-                    if match is not None:
-                        self.local_conf_version = match.group(0)
-
-                    break
-        except (
-            FileNotFoundError,
-            PermissionError,
-            IsADirectoryError,
-            AttributeError,
-            re.error,
-        ):
-            pass
+        self.local_conf_version = self.get_distro_probe().local_conf_version()
 
     def read_bitbake_version(self):
-        self.bitbake_major_version = int(self.distro.DEFAULT_BITBAKE_MAJOR_VERSION)
-        try:
-            file = open(
-                self.config.layer_dir()
-                + self.distro.BASE_DIRECTORY
-                + "/"
-                + self.distro.BITBAKE_INIT_FILE,
-                encoding="utf-8",
-            )
-            for line in file:
-                if "__version__" in line:
-                    self.bitbake_major_version = int(
-                        line.split("=")[1].strip(' "').split(".")[0]
-                    )
-                    return
-        except (
-            FileNotFoundError,
-            PermissionError,
-            IsADirectoryError,
-            IndexError,
-            ValueError,
-        ):
-            pass
+        self.bitbake_major_version = self.get_distro_probe().bitbake_major_version()
 
     def prepare_build_directory(self, build):
         debug("Preparing directory:", build.dir())
@@ -836,58 +1536,52 @@ class CookerCommands:
             "${TOPDIR}", os.path.relpath(self.config.layer_dir(), build.dir())
         )
 
-        self.read_bitbake_version()
         halt_verb = "HALT"
         if self.bitbake_major_version < BITBAKE_VERSION_MINIMUM:
             halt_verb = "ABORT"
 
-        file = CookerCall.os.file_open(os.path.join(conf_path, "local.conf"))
-
-        CookerCall.os.file_write(
-            file, "# DO NOT EDIT! - This file is automatically created by cooker.\n\n"
-        )
-        CookerCall.os.file_write(file, f'COOKER_LAYER_DIR = "{layer_dir}"')
-        CookerCall.os.file_write(file, f'DL_DIR = "{dl_dir}"')
-        CookerCall.os.file_write(file, f'SSTATE_DIR = "{sstate_dir}"')
-        CookerCall.os.file_write(file, f'COOKER_BUILD_NAME = "{build.name()}"')
-        for line in build.local_conf():
-            CookerCall.os.file_write(file, line)
-        CookerCall.os.file_write(file, f'DISTRO ?= "{self.distro.DISTRO_NAME}"')
-        CookerCall.os.file_write(
-            file, f'PACKAGE_CLASSES ?= "{self.distro.PACKAGE_FORMAT}"'
-        )
-        CookerCall.os.file_write(file, 'BB_DISKMON_DIRS ??= "\\')
-        CookerCall.os.file_write(file, "\tSTOPTASKS,${TMPDIR},1G,100K \\")
-        CookerCall.os.file_write(file, "\tSTOPTASKS,${DL_DIR},1G,100K \\")
-        CookerCall.os.file_write(file, "\tSTOPTASKS,${SSTATE_DIR},1G,100K \\")
-        CookerCall.os.file_write(file, "\tSTOPTASKS,/tmp,100M,100K \\")
-        CookerCall.os.file_write(file, f"\t{halt_verb},${{TMPDIR}},100M,1K \\")
-        CookerCall.os.file_write(file, f"\t{halt_verb},${{DL_DIR}},100M,1K \\")
-        CookerCall.os.file_write(file, f"\t{halt_verb},${{SSTATE_DIR}},100M,1K \\")
-        CookerCall.os.file_write(file, f'\t{halt_verb},/tmp,10M,1K"')
-        CookerCall.os.file_write(file, f'CONF_VERSION ?= "{self.local_conf_version}"')
-        CookerCall.os.file_close(file)
-
-        file = CookerCall.os.file_open(os.path.join(conf_path, "bblayers.conf"))
-        CookerCall.os.file_write(
-            file, "# DO NOT EDIT! - This file is automatically created by cooker.\n\n"
-        )
-        CookerCall.os.file_write(
-            file,
+        local_conf = [
+            "# DO NOT EDIT! - This file is automatically created by cooker.\n\n",
+            f'COOKER_LAYER_DIR = "{layer_dir}"',
+            f'DL_DIR = "{dl_dir}"',
+            f'SSTATE_DIR = "{sstate_dir}"',
+            f'COOKER_BUILD_NAME = "{build.name()}"',
+            *build.local_conf(),
+            f'DISTRO ?= "{self.distro.DISTRO_NAME}"',
+            f'PACKAGE_CLASSES ?= "{self.distro.PACKAGE_FORMAT}"',
+            'BB_DISKMON_DIRS ??= "\\',
+            "\tSTOPTASKS,${TMPDIR},1G,100K \\",
+            "\tSTOPTASKS,${DL_DIR},1G,100K \\",
+            "\tSTOPTASKS,${SSTATE_DIR},1G,100K \\",
+            "\tSTOPTASKS,/tmp,100M,100K \\",
+            f"\t{halt_verb},${{TMPDIR}},100M,1K \\",
+            f"\t{halt_verb},${{DL_DIR}},100M,1K \\",
+            f"\t{halt_verb},${{SSTATE_DIR}},100M,1K \\",
+            f'\t{halt_verb},/tmp,10M,1K"',
+            f'CONF_VERSION ?= "{self.local_conf_version}"',
+        ]
+
+        bblayers_conf = [
+            "# DO NOT EDIT! - This file is automatically created by cooker.\n\n",
             f'{self.distro.LAYER_CONF_NAME} = "{self.distro.LAYER_CONF_VERSION}"',
-        )
-        CookerCall.os.file_write(file, 'BBPATH = "${TOPDIR}"')
-        CookerCall.os.file_write(file, 'BBFILES ?= ""')
-        CookerCall.os.file_write(file, 'BBLAYERS ?= " \\')
+            'BBPATH = "${TOPDIR}"',
+            'BBFILES ?= ""',
+            'BBLAYERS ?= " \\',
+        ]
         for layer in build.layers():
             layer_path = os.path.relpath(self.config.layer_dir(layer), build.dir())
-            CookerCall.os.file_write(file, f"    ${{TOPDIR}}/{layer_path} \\")
-        CookerCall.os.file_write(file, '"\n')
-        CookerCall.os.file_close(file)
-
-        file = CookerCall.os.file_open(os.path.join(conf_path, "templateconf.cfg"))
-        CookerCall.os.file_write(file, f"{self.get_template_conf_path()}\n")
-        CookerCall.os.file_close(file)
+            bblayers_conf.append(f"    ${{TOPDIR}}/{layer_path} \\")
+        bblayers_conf.append('"\n')
+
+        # files are only rewritten when their content changes, so that bitbake
+        # does not reparse the metadata of an unchanged build
+        for name, lines in (
+            ("local.conf", local_conf),
+            ("bblayers.conf", bblayers_conf),
+            ("templateconf.cfg", [f"{self.get_template_conf_path()}\n"]),
+        ):
+            if not CookerCall.os.file_update(os.path.join(conf_path, name), lines):
+                debug(f"{name} of {build.name()} is up to date")
 
     # ruff: noqa: C901 PLR0912
     def show(self, builds, layers, conf, tree, build_arg, sources):
@@ -900,18 +1594,18 @@ class CookerCommands:
 
         # check if selected builds exist
         for build in builds:
-            if build not in BuildConfiguration.ALL:
+            if build not in self.graph:
                 fatal_error(
                     f'cannot show infos about build "{build}" as it does not exists.'
                 )
 
         # empty given builds - use all existing ones
         if not builds:
-            builds = BuildConfiguration.ALL.keys()
+            builds = self.graph.names()
 
         # print information per build
         for build_name in sorted(builds):
-            build = BuildConfiguration.ALL[build_name]
+            build = self.graph[build_name]
 
             if build.targets():
                 build_info = " (bakes {})".format(", ".join(build.targets()))
@@ -947,33 +1641,91 @@ class CookerCommands:
                 else:
                     info("build", build.name(), "has no target")
 
-            if tree and build.ancestors_:
-                info("builds ancestors:", [n.name() for n in build.ancestors_])
+            if tree and build.ancestors():
+                info("builds ancestors:", list(build.ancestors()))
 
-    def build(self, builds, sdk, keepgoing, download):
+    def build(self, builds, sdk, keepgoing, download, parallel_builds=1):
         debug("Building build-configurations")
 
-        for build in self.get_buildable_builds(builds):
+        buildables = self.get_buildable_builds(builds)
+        if parallel_builds > 1 and len(buildables) > 1:
+            self.build_parallel(buildables, parallel_builds, sdk, keepgoing, download)
+            return
+
+        for build in buildables:
             self.build_targets(build, sdk, keepgoing, download)
 
-    def build_targets(self, build, sdk, keepgoing, download):
-        for target in build.targets():
-            try:
-                info(f"Building {build.name()} ({target})")
-                bb_task = ""
+    @staticmethod
+    def shared_layers(build, builds):
+        """Returns how many layers the build shares with the other builds."""
+        layers = set(build.layers())
+        return sum(len(layers.intersection(b.layers())) for b in builds if b != build)
+
+    def build_parallel(self, buildables, parallel_builds, sdk, keepgoing, download):
+        """
+        Builds several build directories at once. The build sharing the most
+        layers with the others is built alone first, to seed the shared state
+        directory the others then reuse. The others are built at most
+        `parallel_builds` at a time, each one given its share of the CPUs through
+        BB_NUMBER_THREADS and PARALLEL_MAKE, and their output is printed once
+        they are done.
+        """
+        seed = max(buildables, key=lambda b: self.shared_layers(b, buildables))
+        info(f"Building {seed.name()} first to seed the shared state")
+        self.build_targets(seed, sdk, keepgoing, download)
+
+        others = [build for build in buildables if build != seed]
+        jobs = min(parallel_builds, len(others))
+        threads = max(1, (os.cpu_count() or 1) // jobs)
+        environment = {
+            "BB_NUMBER_THREADS": str(threads),
+            "PARALLEL_MAKE": f"-j {threads}",
+        }
+        info(f"Building {len(others)} builds, {jobs} at a time, {threads} threads each")
+
+        try:
+            run_parallel(
+                lambda build: self.build_targets(
+                    build, sdk, keepgoing, download, environment
+                ),
+                others,
+                jobs,
+            )
+        except ParallelTaskError as e:
+            fatal_error(f"build of {e.item.name()} failed ({e.reason})")
+
+    def build_targets(self, build, sdk, keepgoing, download, environment=None):
+        """
+        Builds all the targets of the build, and their SDK, with a single bitbake
+        run, which parses the metadata once. When this run fails, the targets are
+        built one by one to report the failing one.
+        """
+        targets = list(build.targets())
+        if sdk:
+            targets += [f"{target}:do_populate_sdk" for target in build.targets()]
 
-                if keepgoing:
-                    bb_task = "-k"
+        try:
+            info(f"Building {build.name()} ({', '.join(targets)})")
+            bb_task = ""
 
-                if download:
-                    bb_task += " --runall=fetch"
+            if keepgoing:
+                bb_task = "-k"
 
-                self.run_bitbake(build, bb_task, target)
-                if sdk:
-                    self.run_bitbake(build, "-c populate_sdk", target)
+            if download:
+                bb_task += " --runall=fetch"
 
-            except Exception as e:
-                fatal_error("build for", build.name(), "failed", e)
+            if len(targets) > 1:
+                if self.run_bitbake(
+                    build, bb_task, " ".join(targets), environment, check=False
+                ):
+                    return
+                warn(f"build of {build.name()} failed, building its targets one by one")
+
+            for target in targets:
+                self.run_bitbake(build, bb_task, target, environment)
+
+        except Exception as e:
+            fatal_error("build for", build.name(), "failed", e)
 
     def clean(self, recipe, builds):
         debug(f"cleaning {recipe}")
@@ -988,26 +1740,35 @@ class CookerCommands:
         except Exception as e:
             fatal_error("clean for", build.name(), "failed", e)
 
-    @staticmethod
-    def get_buildable_builds(builds: list[str]):
+    def get_buildable_builds(self, builds: list[str]):
         """gets buildable build-objects from a build-name-list or all of them if list
         is empty."""
 
         if builds:
             buildables = []
             for build in builds:
-                if build not in BuildConfiguration.ALL:
+                if build not in self.graph:
                     fatal_error("undefined build:", build)
 
-                if not BuildConfiguration.ALL[build].targets():
+                if not self.graph[build].targets():
                     fatal_error("build", build, "is not buildable")
 
-                buildables += [BuildConfiguration.ALL[build]]
+                buildables += [self.graph[build]]
             return buildables
         else:  # use all builds which have targets
-            return [x for x in BuildConfiguration.ALL.values() if x.buildable()]
+            return [x for x in self.graph.builds() if x.buildable()]
+
+    def run_bitbake(
+        self, build_config, bb_task, bb_target, environment=None, check=True
+    ):
+        """
+        Runs bitbake in the build directory. The given environment variables are
+        passed to bitbake, whose output is then captured and printed once it is
+        done, so that concurrent builds do not mix their output. The idle timeout
+        of the bitbake server, if configured, is passed too.
 
-    def run_bitbake(self, build_config, bb_task, bb_target):
+        Returns whether bitbake succeeded; a failure is fatal when `check` is set.
+        """
         directory = build_config.dir()
 
         init_script = self.config.layer_dir(
@@ -1018,12 +1779,99 @@ class CookerCommands:
 
         command_line = f". {init_script} {directory} && bitbake {bb_task} {bb_target}"
 
+        exports = self.bitbake_exports(environment)
+        if exports:
+            command_line = f"{exports} && {command_line}"
+
         complete = CookerCall.os.subprocess_run(
-            ["env", "bash", "-c", command_line], None, capture_output=False
+            ["env", "bash", "-c", command_line],
+            None,
+            capture_output=environment is not None,
         )
-        if complete.returncode != 0:
+        if environment is not None:
+            for output, stream in (
+                (complete.stdout, sys.stdout),
+                (complete.stderr, sys.stderr),
+            ):
+                if output:
+                    stream.write(output.decode("utf-8", errors="replace"))
+        if complete.returncode != 0 and check:
             fatal_error(f"Execution of {command_line} failed.")
 
+        return complete.returncode == 0
+
+    def bitbake_exports(self, environment=None):
+        """
+        Returns the shell command exporting the given variables, and the idle
+        timeout of the bitbake server if configured, for bitbake to use them (or
+        None without any variable).
+        """
+        environment = dict(environment or {})
+        if self.config.server_timeout() is not None:
+            environment["BB_SERVER_TIMEOUT"] = str(self.config.server_timeout())
+        if not environment:
+            return None
+
+        self.read_bitbake_version()
+        passthrough = "BB_ENV_PASSTHROUGH_ADDITIONS"
+        if self.bitbake_major_version < BITBAKE_VERSION_MINIMUM:
+            passthrough = "BB_ENV_EXTRAWHITE"
+        variables = [f"{k}={shlex.quote(v)}" for k, v in environment.items()]
+        variables.append(f'{passthrough}="${{{passthrough}}} {" ".join(environment)}"')
+        return f"export {' '.join(variables)}"
+
+    def server(self, action, builds, timeout=None):
+        """
+        cooker-command 'server': start, stop or show the status of the
+        memory-resident bitbake server of the builds. As long as it runs, the
+        bitbake runs in the build directory attach to this server, which keeps the
+        parsed metadata.
+        """
+        if timeout is None:
+            timeout = self.config.server_timeout()
+        if timeout is None:
+            timeout = -1  # until `cooker server stop`
+
+        for build in self.get_buildable_builds(builds):
+            pid = self.bitbake_server_pid(build)
+
+            if action == "status":
+                state = "not running" if pid is None else f"running (pid {pid})"
+                info(f"bitbake server of {build.name()}: {state}")
+            elif action == "start":
+                if not CookerCall.os.file_exists(
+                    os.path.join(build.dir(), "conf", "local.conf")
+                ):
+                    fatal_error(f"build {build.name()} is not generated")
+
+                info(f"Starting the bitbake server of {build.name()}")
+                self.run_bitbake(build, f"--server-only --idle-timeout {timeout}", "")
+            elif pid is None:
+                debug(f"no bitbake server of {build.name()} to stop")
+            else:
+                info(f"Stopping the bitbake server of {build.name()}")
+                self.run_bitbake(build, "--kill-server", "")
+
+    @staticmethod
+    def bitbake_server_pid(build):
+        """
+        Returns the PID of the bitbake server running in the build directory, as
+        written in its lock file, or None if there is none.
+        """
+        if not os.path.exists(os.path.join(build.dir(), "bitbake.sock")):
+            return None
+
+        try:
+            with open(
+                os.path.join(build.dir(), "bitbake.lock"), encoding="utf-8"
+            ) as file:
+                pid = int(file.readline().split()[0])
+            os.kill(pid, 0)
+        except (OSError, ValueError, IndexError):
+            return None
+
+        return pid
+
     def shell(self, build_names: list[str], cmd: list[str]):
         build_dir = self.get_buildable_builds(build_names)[0].dir()
         init_script = self.config.layer_dir(
@@ -1031,6 +1879,8 @@ class CookerCommands:
         )
         base_dir = self.config.layer_dir(self.distro.BASE_DIRECTORY)
         shell = os.environ.get("SHELL", "/bin/bash")
+        exports = self.bitbake_exports()
+        exports = f"{exports}; " if exports else ""
 
         if len(cmd) >= 1:
             str_cmd = shlex.join(cmd)
@@ -1039,7 +1889,7 @@ class CookerCommands:
                 f"shell {build_dir} {init_script} {shell}"
             )
             full_command_line = (
-                f"set {build_dir}; . {init_script} {build_dir} > "
+                f"{exports}set {build_dir}; . {init_script} {build_dir} > "
                 f"/dev/null || exit 1; {str_cmd}"
             )
             if not CookerCall.os.subprocess_run(
@@ -1057,8 +1907,8 @@ class CookerCommands:
                 [
                     shell,
                     "-c",
-                    f"cd {base_dir}; set {build_dir}; . {init_script} {build_dir}; "
-                    f"{shell}",
+                    f"cd {base_dir}; {exports}set {build_dir}; . {init_script} "
+                    f"{build_dir}; {shell}",
                 ],
             ):
                 fatal_error(
@@ -1114,6 +1964,17 @@ class CookerCall:
             action="store_true",
             help="print what would have been done (without doing anything)",
         )
+        remote_refs_group = parser.add_mutually_exclusive_group()
+        remote_refs_group.add_argument(
+            "--offline",
+            action="store_true",
+            help="never query remotes for their refs, use the cached answers",
+        )
+        remote_refs_group.add_argument(
+            "--refresh",
+            action="store_true",
+            help="ignore the cached answers of remotes and query them again",
+        )
 
         # parsing subcommand's arguments
         subparsers = parser.add_subparsers(
@@ -1139,6 +2000,32 @@ class CookerCall:
         cook_parser.add_argument(
             "-s", "--sdk", action="store_true", help="build also the SDK"
         )
+        cook_parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="number of sources updated in parallel, each build being generated"
+            + " and built as soon as its sources are ready (default: 1)",
+        )
+        cook_parser.add_argument(
+            "--parallel-builds",
+            type=int,
+            default=1,
+            help="number of builds run at once, after a first one seeding the shared"
+            + " state (default: 1)",
+        )
+        cook_parser.add_argument(
+            "--submodule-jobs",
+            type=int,
+            default=1,
+            help="number of submodules of a source fetched in parallel (default: 1)",
+        )
+        cook_parser.add_argument(
+            "--locked",
+            action="store_true",
+            help="check out the commits recorded in the lock file",
+        )
         cook_parser.add_argument(
             "-m",
             "--menu",
@@ -1180,6 +2067,23 @@ class CookerCall:
         init_parser.add_argument(
             "-s", "--sstate-dir", help="path where shared state cached will be saved"
         )
+        init_parser.add_argument(
+            "--mirror-dir",
+            help="path where bare mirrors of the sources, shared between projects,"
+            + " will be saved",
+        )
+        init_parser.add_argument(
+            "--remote-refs-ttl",
+            type=int,
+            help="number of seconds the refs of remotes are cached (default: "
+            + f"{Config.DEFAULT_REMOTE_REFS_TTL})",
+        )
+        init_parser.add_argument(
+            "--server-timeout",
+            type=int,
+            help="number of idle seconds before the bitbake server of a build-dir is"
+            + " unloaded, -1 to keep it (default: bitbake's)",
+        )
         init_parser.add_argument(
             "-m",
             "--menu",
@@ -1199,12 +2103,50 @@ class CookerCall:
 
         # `update` command
         update_parser = subparsers.add_parser("update", help="update source layers")
+        update_parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="number of sources updated in parallel (default: 1)",
+        )
+        update_parser.add_argument(
+            "--submodule-jobs",
+            type=int,
+            default=1,
+            help="number of submodules of a source fetched in parallel (default: 1)",
+        )
+        update_parser.add_argument(
+            "--locked",
+            action="store_true",
+            help="check out the commits recorded in the lock file",
+        )
+        update_parser.add_argument(
+            "builds",
+            help="build-configurations whose sources are updated (default: all"
+            + " sources)",
+            nargs="*",
+        )
         update_parser.set_defaults(func=self.update)
 
         # `diff` command
         diff_parser = subparsers.add_parser(
             "diff", help="show current revision differences of all sources"
         )
+        diff_parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="number of sources checked in parallel (default: 1)",
+        )
+        diff_parser.add_argument(
+            "-f",
+            "--fast",
+            action="store_true",
+            help="only describe the sources whose commit differs from the menu"
+            + " (local modifications are ignored)",
+        )
         diff_parser.set_defaults(func=self.diff)
 
         # `log` command
@@ -1239,6 +2181,16 @@ class CookerCall:
         generate_parser = subparsers.add_parser(
             "generate", help="generate build-configuration"
         )
+        generate_parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="number of build directories prepared in parallel (default: 1)",
+        )
+        generate_parser.add_argument(
+            "builds", help="build-configurations to generate", nargs="*"
+        )
         generate_parser.set_defaults(func=self.generate)
 
         # `show` command
@@ -1310,6 +2262,13 @@ class CookerCall:
         build_parser.add_argument(
             "-s", "--sdk", action="store_true", help="build also the SDK"
         )
+        build_parser.add_argument(
+            "--parallel-builds",
+            type=int,
+            default=1,
+            help="number of builds run at once, after a first one seeding the shared"
+            + " state (default: 1)",
+        )
         build_parser.add_argument(
             "builds", help="build-configuration to build", nargs="*"
         )
@@ -1340,6 +2299,25 @@ class CookerCall:
         )
         clean_parser.set_defaults(func=self.clean)
 
+        # `server` command
+        server_parser = subparsers.add_parser(
+            "server", help="manage the memory-resident bitbake server of builds"
+        )
+        server_parser.add_argument(
+            "action", help="what to do", choices=["start", "stop", "status"]
+        )
+        server_parser.add_argument(
+            "-t",
+            "--timeout",
+            type=int,
+            help="number of idle seconds before a started server is unloaded, -1 to"
+            + " keep it (default: the one given to `cooker init`, or -1)",
+        )
+        server_parser.add_argument(
+            "builds", help="build-configurations concerned", nargs="*"
+        )
+        server_parser.set_defaults(func=self.server)
+
         self.clargs = parser.parse_args()
 
         CookerCall.DEBUG = self.clargs.debug
@@ -1385,67 +2363,60 @@ class CookerCall:
                 fatal_error("menu load error", e)
 
         self.menu = dict()
+        self.graph = BuildGraph(self.config, self.menu)
         self.additional_menus = list()
         if menu_file:
             try:
-                with menu_file.open(encoding="utf-8") as handle:
-                    self.menu = pyjson5.load(handle)
+                menus = [menu_file.read_bytes()]
+                menu_names = [str(menu_file)]
             except Exception as e:
                 fatal_error("menu load error:", e)
 
             try:
-                if additional_menus is not None:
-                    for menu_file in additional_menus:
-                        with menu_file.open(encoding="utf-8") as handle:
-                            additional_menu = pyjson5.load(handle)
-                        self.additional_menus.append(menu_file)
-                        self.menu = merge_dicts(self.menu, additional_menu)
-                        pass
+                for menu_file in additional_menus:
+                    menus.append(menu_file.read_bytes())
+                    menu_names.append(str(menu_file))
+                    self.additional_menus.append(menu_file)
             except Exception as e:
                 fatal_error("menu load error:", e)
-            schema_file = (
-                importlib.resources.files("cooker")
-                .joinpath("cooker-menu-schema.json")
-                .read_text()
-            )
-            schema = pyjson5.loads(schema_file)
 
-            try:
-                jsonschema.validate(self.menu, schema)
-            except Exception as e:
-                fatal_error("menu file validation failed:", e)
+            schema_file = read_menu_schema()
+
+            # the compiled menu is only cached in an initialized project
+            menu_cache = None
+            compiled = None
+            ancestors = None
+            if not self.config.empty():
+                menu_cache = MenuCache(self.config.cache_dir("menu.json"))
+                key = MenuCache.key(__version__, schema_file, menus)
+                compiled = menu_cache.load(key)
+
+            if compiled is not None:
+                self.menu, ancestors = compiled
+                debug("compiled menu loaded from cache")
+            else:
+                self.menu = self.compile_menu(menus, menu_names)
 
-            debug("menu file validation passed")
             debug("---start-menu-dump---")
             debug(json.dumps(self.menu, indent=2))
             debug("---end-menu-dump---")
-            # create build-configurations and resolve parents
-
-            # the main config is root containing the menu's layers and
-            # local.conf-fields
-
-            BuildConfiguration(
-                "root",
-                self.config,
-                self.menu.setdefault("layers", []),
-                self.menu.setdefault("local.conf", []),
-                None,
-                None,
-            )
-
-            for name, build in self.menu["builds"].items():
-                BuildConfiguration(
-                    name,
-                    self.config,
-                    build.setdefault("layers", []),
-                    build.setdefault("local.conf", []),
-                    build.setdefault("target", None),
-                    build.setdefault("inherit", ["root"]),
-                )
-
-            resolve_parents()
+            # resolve the builds, unless their ancestors are known from the cache
+            self.graph = BuildGraph(self.config, self.menu, ancestors)
+            # a dry run writes nothing, not even the cache
+            if (
+                compiled is None
+                and menu_cache is not None
+                and not isinstance(CookerCall.os, DryRunOsCalls)
+            ):
+                menu_cache.save(key, self.menu, self.graph.ancestry())
 
-        self.commands = CookerCommands(self.config, self.menu)
+        self.commands = CookerCommands(
+            self.config,
+            self.menu,
+            self.clargs.offline,
+            self.clargs.refresh,
+            self.graph,
+        )
 
         if "func" in self.clargs:
             self.clargs.func()  # call function of selected command
@@ -1455,6 +2426,31 @@ class CookerCall:
 
         sys.exit(0)
 
+    @staticmethod
+    def compile_menu(menus, names):
+        """Parse, merge and validate the contents of the menu files."""
+        import pyjson5
+
+        merge = MenuMerge()
+        try:
+            for name, content in zip(names, menus, strict=True):
+                merge.add(name, pyjson5.loads(content.decode("utf-8")))
+        except Exception as e:
+            fatal_error("menu load error:", e)
+
+        for path, replaced, by in merge.overrides:
+            debug(f"menu value {list(path)} of {replaced} overridden by {by}")
+
+        menu = merge.menu()
+
+        try:
+            validate_menu(menu)
+        except Exception as e:
+            fatal_error("menu file validation failed:", e)
+
+        debug("menu file validation passed")
+        return menu
+
     def init(self):
         """function use by command-line-arg-parser as entry point for the 'init'"""
         if not self.clargs.force and not self.config.empty():
@@ -1469,6 +2465,9 @@ class CookerCall:
             self.clargs.dl_dir,
             self.clargs.sstate_dir,
             additional_menus=self.additional_menus,
+            mirror_dir=self.clargs.mirror_dir,
+            remote_refs_ttl=self.clargs.remote_refs_ttl,
+            server_timeout=self.clargs.server_timeout,
         )
 
     def update(self):
@@ -1476,13 +2475,18 @@ class CookerCall:
         if not self.menu:
             fatal_error("update needs a menu")
 
-        self.commands.update()
+        self.commands.update(
+            self.clargs.jobs,
+            self.clargs.submodule_jobs,
+            self.clargs.locked,
+            self.clargs.builds,
+        )
 
     def diff(self):
         if not self.menu:
             fatal_error("diff needs a menu")
 
-        self.commands.diff()
+        self.commands.diff(self.clargs.jobs, self.clargs.fast)
 
     def log(self):
         self.commands.log(
@@ -1497,20 +2501,22 @@ class CookerCall:
         self.commands.init(
             str(self.clargs.menu[0]), additional_menus=self.additional_menus
         )
-        self.commands.update()
-        self.commands.generate()
-        self.commands.build(
+        self.commands.cook(
             self.clargs.builds,
+            self.clargs.jobs,
+            self.clargs.submodule_jobs,
+            self.clargs.locked,
             self.clargs.sdk,
             self.clargs.keepgoing,
             self.clargs.download,
+            self.clargs.parallel_builds,
         )
 
     def generate(self):
         if not self.menu:
             fatal_error("generate needs a menu")
 
-        self.commands.generate()
+        self.commands.generate(self.clargs.builds, self.clargs.jobs)
 
     def show(self):
         if not self.menu:
@@ -1534,6 +2540,7 @@ class CookerCall:
             self.clargs.sdk,
             self.clargs.keepgoing,
             self.clargs.download,
+            self.clargs.parallel_builds,
         )
 
     def shell(self):
@@ -1542,6 +2549,14 @@ class CookerCall:
 
         self.commands.shell(self.clargs.build, self.clargs.cmd)
 
+    def server(self):
+        if not self.menu:
+            fatal_error("server needs a menu")
+
+        self.commands.server(
+            self.clargs.action, self.clargs.builds, self.clargs.timeout
+        )
+
     def clean(self):
         if not self.menu:
             fatal_error("clean needs a menu")
@@ -0,0 +1,179 @@
+import os
+import re
+import threading
+
+from .os_calls import read_json_file, write_json_file
+
+
+def checked_out_commit(directory):
+    """
+    Return the commit checked out in a git repository (or worktree), read from
+    its files without starting git, or None if it cannot be found.
+    """
+    git_dir = os.path.join(directory, ".git")
+    try:
+        if os.path.isfile(git_dir):  # worktree: ".git" tells where its files are
+            with open(git_dir, encoding="utf-8") as file:
+                git_dir = os.path.join(
+                    directory, file.read().strip().removeprefix("gitdir: ")
+                )
+
+        with open(os.path.join(git_dir, "HEAD"), encoding="utf-8") as file:
+            head = file.read().strip()
+        if not head.startswith("ref: "):  # detached HEAD
+            return head
+        ref = head.removeprefix("ref: ")
+
+        common_dir = git_dir
+        if os.path.isfile(os.path.join(git_dir, "commondir")):
+            with open(os.path.join(git_dir, "commondir"), encoding="utf-8") as file:
+                common_dir = os.path.join(git_dir, file.read().strip())
+
+        try:
+            with open(os.path.join(common_dir, ref), encoding="utf-8") as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            with open(
+                os.path.join(common_dir, "packed-refs"), encoding="utf-8"
+            ) as file:
+                for line in file:
+                    commit, _, name = line.strip().partition(" ")
+                    if name == ref:
+                        return commit
+    except OSError:
+        pass
+
+    return None
+
+
+class DistroProbe:
+    """Finds the facts about the base directory of a distro needed to generate
+    build directories: the template conf directory holding `local.conf.sample`,
+    the `CONF_VERSION` it gives and the major version of bitbake.
+
+    The facts are probed once per run. With a `cache_file`, they are also kept
+    between runs for the commit checked out in the base directory, and are not
+    probed again until this commit changes (`refresh` ignores this cache). A
+    `read_only` cache is used but never written.
+    """
+
+    def __init__(
+        self, distro, base_dir, cache_file=None, refresh=False, read_only=False
+    ):
+        self._distro = distro
+        self._base_dir = base_dir
+        self._cache_file = cache_file
+        self._refresh = refresh
+        self._read_only = read_only
+        self._facts: dict | None = None
+        self._lock = threading.Lock()
+
+    def _key(self):
+        """Identify the base directory content and the distro's probed paths."""
+        commit = checked_out_commit(self._base_dir)
+        if commit is None:
+            return None
+
+        return "\n".join(
+            [
+                self._base_dir,
+                commit,
+                *self._distro.TEMPLATE_CONF,
+                self._distro.BITBAKE_INIT_FILE,
+            ]
+        )
+
+    def _load(self, key):
+        cached = read_json_file(self._cache_file)
+        if not isinstance(cached, dict) or cached.get("key") != key:
+            return None
+        return cached.get("facts")
+
+    def _save(self, key, facts):
+        write_json_file(self._cache_file, {"key": key, "facts": facts}, indent=4)
+
+    def facts(self):
+        with self._lock:
+            if self._facts is not None:
+                return self._facts
+
+            key = self._key() if self._cache_file else None
+            if key is not None and not self._refresh:
+                self._facts = self._load(key)
+
+            if self._facts is None:
+                self._facts = self._probe()
+                if key is not None and not self._read_only:
+                    self._save(key, self._facts)
+
+            return self._facts
+
+    def template_conf(self):
+        return self.facts()["template_conf"]
+
+    def local_conf_version(self):
+        return self.facts()["local_conf_version"]
+
+    def bitbake_major_version(self):
+        return self.facts()["bitbake_major_version"]
+
+    def _probe(self):
+        template_conf = self._probe_template_conf()
+        return {
+            "template_conf": template_conf,
+            "local_conf_version": self._probe_local_conf_version(template_conf),
+            "bitbake_major_version": self._probe_bitbake_major_version(),
+        }
+
+    def _probe_template_conf(self):
+        """Return the first template conf directory holding `local.conf.sample`."""
+        for template_conf in self._distro.TEMPLATE_CONF:
+            full_path = os.path.join(self._base_dir, template_conf, "local.conf.sample")
+            if os.path.exists(full_path):
+                return template_conf
+        return None
+
+    def _probe_local_conf_version(self, template_conf):
+        version = str(self._distro.DEFAULT_CONF_VERSION)
+        if template_conf is None:
+            return version
+
+        try:
+            with open(
+                os.path.join(self._base_dir, template_conf, "local.conf.sample"),
+                encoding="utf-8",
+            ) as file:
+                for line in file:
+                    if not line.lstrip().startswith("CONF_VERSION"):
+                        continue
+
+                    match = re.search(r"\d+", line)
+
+                    if match is not None:
+                        version = match.group(0)
+
+                    break
+        except (FileNotFoundError, PermissionError, IsADirectoryError):
+            pass
+
+        return version
+
+    def _probe_bitbake_major_version(self):
+        try:
+            with open(
+                os.path.join(self._base_dir, self._distro.BITBAKE_INIT_FILE),
+                encoding="utf-8",
+            ) as file:
+                for line in file:
+                    if "__version__" in line:
+                        return int(line.split("=")[1].strip(' "').split(".")[0])
+        except (
+            FileNotFoundError,
+            PermissionError,
+            IsADirectoryError,
+            IndexError,
+            ValueError,
+        ):
+            pass
+
+        return int(self._distro.DEFAULT_BITBAKE_MAJOR_VERSION)
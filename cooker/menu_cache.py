@@ -0,0 +1,37 @@
+import hashlib
+
+from .os_calls import read_json_file, write_json_file
+
+
+class MenuCache:
+    """Keeps the compiled menu of a project between runs: the merge of its menu
+    files once validated, and the ancestors of each build.
+
+    An entry is identified by a hash of the contents of the menu files, of the
+    menu schema and of the cooker version, so that it is used only as long as
+    none of them changes.
+    """
+
+    def __init__(self, cache_file):
+        self._cache_file = cache_file
+
+    @staticmethod
+    def key(version, schema, menus):
+        """Return the key of the compiled menu of the menu file contents."""
+        digest = hashlib.sha256()
+        for part in [version.encode(), schema.encode(), *menus]:
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def load(self, key):
+        """Return the menu and the build ancestors cached for the key, or None."""
+        cached = read_json_file(self._cache_file)
+        if not isinstance(cached, dict) or cached.get("key") != key:
+            return None
+        return cached["menu"], cached["ancestors"]
+
+    def save(self, key, menu, ancestors):
+        write_json_file(
+            self._cache_file, {"key": key, "menu": menu, "ancestors": ancestors}
+        )
@@ -0,0 +1,89 @@
+from collections.abc import Mapping
+
+
+def source_key(source):
+    """Identify a source of a menu: by its local directory if given, or its URL."""
+    return source.get("dir") or source.get("url")
+
+
+class MenuMerge:
+    """Merges a menu with its additional menus (overlays), in one pass over them.
+
+    Mappings are merged recursively, lists are concatenated and other values are
+    replaced by the ones of later overlays. `sources` are merged by directory or
+    URL, the fields of a source given again updating it in place, and the
+    `layers` of the menu and of its builds are kept once each, in order.
+
+    The overlay giving each merged value is recorded in `origins`, by the path
+    of the value (e.g. `("sources", "poky", "rev")`).
+    """
+
+    def __init__(self):
+        self._menu: dict = {}
+        self._sources: dict = {}  # sources by key, in menu order
+        self._layers: dict = {}  # ordered sets of the layer lists, by path
+        self.origins: dict[tuple, str] = {}
+        self.overrides: list[tuple[tuple, str, str]] = []  # path, replaced, by
+
+    def add(self, name, overlay):
+        """Merge an overlay, identified by `name`, over the menus already added."""
+        for key, value in overlay.items():
+            if key == "sources" and isinstance(value, list):
+                self._menu[key] = self._sources  # replaced by its values in menu()
+                for source in value:
+                    self._add_source(name, source)
+            else:
+                self._merge(name, self._menu, (key,), value)
+
+    def menu(self):
+        """Return the merged menu."""
+        if self._menu.get("sources") is self._sources:
+            self._menu["sources"] = list(self._sources.values())
+        for path, layers in self._layers.items():
+            parent = self._menu
+            for key in path[:-1]:
+                parent = parent[key]
+            parent[path[-1]] = list(layers)
+        return self._menu
+
+    def _record(self, name, path):
+        previous = self.origins.get(path)
+        if previous is not None:
+            self.overrides.append((path, previous, name))
+        self.origins[path] = name
+
+    def _add_source(self, name, source):
+        key = source_key(source)
+        if key is None:  # invalid, kept as is for the validation to report it
+            key = len(self._sources)
+        merged = self._sources.setdefault(key, {})
+        for field, value in source.items():
+            merged[field] = value
+            self._record(name, ("sources", key, field))
+
+    def _merge(self, name, base, path, value):
+        key = path[-1]
+        if isinstance(value, Mapping):
+            if not isinstance(base.get(key), dict):
+                base[key] = {}
+            for k, v in value.items():
+                self._merge(name, base[key], (*path, k), v)
+        elif isinstance(value, list) and self._is_layers(path):
+            layers = self._layers.setdefault(path, {})
+            base[key] = layers  # replaced by the list of its keys in menu()
+            for layer in value:
+                if layer not in layers:
+                    layers[layer] = None
+                    self.origins[(*path, layer)] = name
+        elif isinstance(value, list) and isinstance(base.get(key), list):
+            base[key].extend(value)
+        elif isinstance(value, list):
+            base[key] = list(value)
+            self._record(name, path)
+        else:
+            base[key] = value
+            self._record(name, path)
+
+    @staticmethod
+    def _is_layers(path):
+        return path == ("layers",) or (path[0] == "builds" and path[2:] == ("layers",))
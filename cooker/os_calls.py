@@ -1,28 +1,63 @@
+import contextlib
+import fcntl
+import json
 import os
+import stat
 import subprocess
 import sys
+import tempfile
 from abc import ABC, abstractmethod
 
+# the umask of the process, giving the mode of the files it creates; it can only
+# be read by changing it, which must not be done once threads are running
+UMASK = os.umask(0o022)
+os.umask(UMASK)
 
-class OsCallsBase(ABC):
-    @staticmethod
-    @abstractmethod
-    def create_directory(directory):
-        pass
 
-    @staticmethod
-    @abstractmethod
-    def file_open(filename):
-        pass
+def replace_file(filename, content):
+    """
+    Replace the file with the content (bytes) atomically, through a temporary file
+    renamed over it. The file keeps its mode, a new one gets the mode of the umask.
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except OSError:
+        mode = 0o666 & ~UMASK
+
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(filename),
+        prefix=f".{os.path.basename(filename)}.",
+        delete=False,
+    ) as file:
+        file.write(content)
+    os.chmod(file.name, mode)
+    os.replace(file.name, filename)
 
+
+def read_json_file(filename):
+    """Return the data of a JSON file, or None if it cannot be read or parsed."""
+    try:
+        with open(filename, encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json_file(filename, data, indent=None):
+    """Write the data to a JSON file atomically, creating its directory if needed."""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    replace_file(filename, json.dumps(data, indent=indent).encode("utf-8"))
+
+
+class OsCallsBase(ABC):
     @staticmethod
     @abstractmethod
-    def file_write(file, string):
+    def create_directory(directory):
         pass
 
     @staticmethod
     @abstractmethod
-    def file_close(file):
+    def file_update(filename, lines):
         pass
 
     @staticmethod
@@ -45,6 +80,11 @@ class OsCallsBase(ABC):
     def subprocess_run(args, cwd, capture_output=True):
         pass
 
+    @staticmethod
+    @abstractmethod
+    def file_lock(filename):
+        pass
+
 
 class OsCalls(OsCallsBase):
     @staticmethod
@@ -52,16 +92,22 @@ class OsCalls(OsCallsBase):
         os.makedirs(directory, exist_ok=True)
 
     @staticmethod
-    def file_open(filename):
-        return open(filename, "w", encoding="utf-8")
-
-    @staticmethod
-    def file_write(file, string):
-        file.write(f"{string}\n")
-
-    @staticmethod
-    def file_close(file):
-        file.close()
+    def file_update(filename, lines):
+        """
+        Write the lines to the file, unless it already has this content, so that
+        its modification time only changes with its content. The file is replaced
+        atomically. Returns whether the file was written.
+        """
+        content = "".join(f"{line}\n" for line in lines).encode("utf-8")
+        try:
+            with open(filename, "rb") as file:
+                if file.read() == content:
+                    return False
+        except OSError:
+            pass
+
+        replace_file(filename, content)
+        return True
 
     @staticmethod
     def file_exists(filename):
@@ -79,6 +125,20 @@ class OsCalls(OsCallsBase):
     def subprocess_run(args, cwd, capture_output=True):
         return subprocess.run(args, capture_output=capture_output, cwd=cwd, check=False)
 
+    @staticmethod
+    @contextlib.contextmanager
+    def file_lock(filename):
+        """
+        Hold an exclusive lock on the file, created if needed, shared with the
+        other processes of the host (unlike a threading.Lock).
+        """
+        with open(filename, "a", encoding="utf-8") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
 
 class DryRunOsCalls(OsCallsBase):
     @staticmethod
@@ -87,21 +147,14 @@ class DryRunOsCalls(OsCallsBase):
         sys.stdout.flush()
 
     @staticmethod
-    def file_open(filename):
+    def file_update(filename, lines):
         print(f"cat > {filename} <<-EOF")
-        sys.stdout.flush()
-        return 0
-
-    @staticmethod
-    def file_write(file, string):
-        escaped = string.replace("$", "\$")
-        print(f"\t{escaped}")
-        sys.stdout.flush()
-
-    @staticmethod
-    def file_close(file):
+        for line in lines:
+            escaped = line.replace("$", "\$")
+            print(f"\t{escaped}")
         print("EOF")
         sys.stdout.flush()
+        return True
 
     @staticmethod
     def file_exists(filename):
@@ -123,3 +176,8 @@ class DryRunOsCalls(OsCallsBase):
         print(" ".join(args))
         sys.stdout.flush()
         return subprocess.CompletedProcess(args, 0, stderr="")
+
+    @staticmethod
+    @contextlib.contextmanager
+    def file_lock(filename):
+        yield
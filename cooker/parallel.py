@@ -0,0 +1,131 @@
+import sys
+import threading
+
+# concurrent.futures is only imported when calls really run in parallel
+# ruff: noqa: PLC0415
+
+
+class ParallelTaskError(Exception):
+    """Raised when one of the items handled by run_parallel() failed."""
+
+    def __init__(self, item, reason):
+        super().__init__(reason)
+        self.item = item
+        self.reason = reason
+
+
+class _ThreadOutput:
+    """File-like proxy redirecting writes of worker threads to their own buffer.
+
+    Threads without a buffer (the main thread) write to the wrapped stream.
+    """
+
+    def __init__(self, stream, local):
+        self._stream = stream
+        self._local = local
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            return self._stream.write(text)
+        buffer.append((self._stream, text))
+        return len(text)
+
+    def flush(self):
+        if getattr(self._local, "buffer", None) is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _replay(buffer):
+    for stream, text in buffer:
+        stream.write(text)
+    for stream in {stream for stream, _ in buffer}:
+        stream.flush()
+
+
+def _collect(futures):
+    """Wait for the worker futures, printing their output in submission order.
+
+    Pending futures are cancelled as soon as one of them reports an error.
+    Return the list of results and the index of the failed future (or None).
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    results = [None] * len(futures)
+    failure = None
+    pending = set(futures)
+    next_index = 0
+
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            if failure is None and not future.cancelled() and future.result()[2]:
+                failure = futures.index(future)
+                for other in pending:
+                    other.cancel()
+
+        while next_index < len(futures) and futures[next_index].done():
+            future = futures[next_index]
+            if not future.cancelled():
+                results[next_index], buffer, _ = future.result()
+                _replay(buffer)
+            next_index += 1
+
+    return results, failure
+
+
+def run_parallel(function, items, jobs):
+    """Call `function` for each of `items`, running at most `jobs` calls at a time.
+
+    Console output (stdout and stderr) of each call is collected and printed in
+    the order of `items`, so that concurrent calls do not interleave. Return the
+    list of results in the order of `items`.
+
+    After the first failed call (exception or sys.exit(), e.g. from
+    fatal_error()), no new call is started; the running ones are waited for,
+    their output printed, and a ParallelTaskError is raised for the failed item.
+
+    With `jobs` lower than 2, items are handled one by one in the calling thread
+    and errors are not intercepted.
+    """
+    items = list(items)
+
+    if jobs <= 1:
+        return [function(item) for item in items]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    local = threading.local()
+
+    def worker(item):
+        local.buffer = []
+        error = None
+        result = None
+        try:
+            result = function(item)
+        except SystemExit as e:
+            error = f"exited with status {e.code}"
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        buffer = local.buffer
+        local.buffer = None
+        return result, buffer, error
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = _ThreadOutput(stdout, local)
+    sys.stderr = _ThreadOutput(stderr, local)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(worker, item) for item in items]
+            results, failure = _collect(futures)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    if failure is not None:
+        raise ParallelTaskError(items[failure], futures[failure].result()[2])
+
+    return results
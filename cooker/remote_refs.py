@@ -0,0 +1,112 @@
+import threading
+import time
+
+from .os_calls import read_json_file, write_json_file
+
+
+class RemoteRefs:
+    """Tells which commits the refs of remote repositories point to.
+
+    A remote is only asked for the refs actually needed, and its answers are
+    kept for the rest of the run, so that several sources hosted on the same
+    remote share a single query.
+
+    With a `cache_file`, answers are also kept on disk between runs and reused
+    while they are younger than `ttl` seconds. In `offline` mode remotes are
+    never queried and cached answers are used whatever their age; `refresh`
+    ignores the answers cached by previous runs.
+    """
+
+    def __init__(self, ls_remote, cache_file=None, ttl=0, offline=False, refresh=False):
+        # ls_remote(url, refs) returns the output of `git ls-remote url refs...`
+        # or None if the remote could not be queried; as git matches the refs
+        # once received, it should restrict the remote to their namespace
+        # (`--tags`, `--heads`: a ref-prefix request with protocol version 2)
+        self._ls_remote = ls_remote
+        self._known: dict[str, dict[str, str | None]] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+        self._cache_file = cache_file
+        self._ttl = ttl
+        self._offline = offline
+        self._cached: dict[str, dict[str, list]] = {}  # url: {ref: [commit, time]}
+        self._modified = False
+
+        if cache_file and not refresh:
+            self._cached = self.load(cache_file)
+
+    @staticmethod
+    def load(cache_file):
+        cached = read_json_file(cache_file)
+        return cached if isinstance(cached, dict) else {}
+
+    def save(self):
+        """Write the cache file if new answers were received during this run."""
+        if not self._cache_file or not self._modified:
+            return
+
+        write_json_file(self._cache_file, self._cached, indent=4)
+        self._modified = False
+
+    def _from_cache(self, url, refs):
+        """Return the answers of previous runs which are still valid."""
+        cached = self._cached.get(url, {})
+        now = time.time()
+        return {
+            ref: cached[ref][0]
+            for ref in refs
+            if ref in cached and (self._offline or now - cached[ref][1] < self._ttl)
+        }
+
+    def _url_lock(self, url):
+        with self._lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+    @staticmethod
+    def parse(output, refs):
+        """Parse `git ls-remote` output, return the commits of the given refs."""
+        found = {}
+        for line in output.splitlines():
+            commit, _, name = line.partition("\t")
+            if name.endswith("^{}"):  # peeled annotated tag: the tagged commit
+                found[name[:-3]] = commit
+            else:
+                found.setdefault(name, commit)
+        return {ref: found.get(ref) for ref in refs}
+
+    def resolve(self, url, refs):
+        """
+        Return a dict mapping each of the full ref names (e.g. `refs/tags/v1.0`)
+        to the commit it points to on the remote, or None if it does not exist
+        there. Only the refs not already known are asked to the remote. If the
+        remote cannot (or must not) be queried, the unknown refs map to None and
+        are not kept.
+        """
+        with self._url_lock(url):
+            known = self._known.setdefault(url, {})
+            missing = [ref for ref in dict.fromkeys(refs) if ref not in known]
+
+            if missing:
+                known.update(self._from_cache(url, missing))
+                missing = [ref for ref in missing if ref not in known]
+
+            if missing and not self._offline:
+                output = self._ls_remote(url, missing)
+                if output is not None:
+                    answers = self.parse(output, missing)
+                    known.update(answers)
+
+                    now = time.time()
+                    cached = self._cached.setdefault(url, {})
+                    for ref, commit in answers.items():
+                        cached[ref] = [commit, now]
+                    self._modified = True
+
+            return {ref: known.get(ref) for ref in refs}
+
+    def has_tag(self, url, tag):
+        return self.resolve(url, [f"refs/tags/{tag}"])[f"refs/tags/{tag}"] is not None
+
+    def branch_head(self, url, branch):
+        return self.resolve(url, [f"refs/heads/{branch}"])[f"refs/heads/{branch}"]